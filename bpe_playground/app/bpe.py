@@ -1,91 +1,240 @@
+import functools
+import heapq
+import re
+from array import array
+from collections import Counter, defaultdict
+from itertools import pairwise
+
+# Whitespace runs and non-whitespace runs; the pieces concatenate back to the text
+SPLIT_PATTERN = re.compile(r"\S+|\s+")
+ENCODE_CACHE_SIZE = 100_000
+# Longer pieces are cut into chunks so one unbroken run cannot dominate encoding
+MAX_PIECE_LEN = 500
+
+
+def split_pieces(text, max_piece_len=MAX_PIECE_LEN):
+    """Split text with SPLIT_PATTERN, cutting pieces longer than max_piece_len characters."""
+    pieces = []
+    for piece in SPLIT_PATTERN.findall(text):
+        if len(piece) > max_piece_len:
+            pieces.extend(piece[i:i + max_piece_len] for i in range(0, len(piece), max_piece_len))
+        else:
+            pieces.append(piece)
+    return pieces
+
+
 class BPEProcessor:
-    def __init__(self):
+    def __init__(self, max_piece_len=MAX_PIECE_LEN):
         """
         Initializes the BPEProcessor class.
 
         Args:
-        num_merges (int): The number of merge operations to perform during BPE.
+        max_piece_len (int): Pieces longer than this many characters are split into chunks.
         """
-        # self.num_merges = num_merges
+        self.max_piece_len = max_piece_len
         self.merges = {}
-        self.vocab = {}
+        # Byte tokens up front; learn_bpe adds each merged token as it is learned
+        self.vocab = {idx: bytes([idx]) for idx in range(256)}
+        # Per-instance cache of encoded pieces; cleared whenever merges change
+        self._encode_piece = functools.lru_cache(maxsize=ENCODE_CACHE_SIZE)(self._encode_piece)
 
     def get_stats(self, ids):
         """Get token pair statistics."""
-        counts = {}
-        for pair in zip(ids, ids[1:]):
-            counts[pair] = counts.get(pair, 0) + 1
-        return counts
-
-    def merge(self, ids, pair, idx):
-        """Merge a pair of tokens in the token list with a new token."""
-        newids = []
+        return Counter(pairwise(ids))
+
+    def _typecode(self, max_id):
+        """Smallest array typecode that can hold token ids up to max_id."""
+        if max_id < 256:
+            return "B"
+        return "H" if max_id < 65536 else "I"
+
+    def merge(self, ids, pair, idx, typecode="I", changes=None):
+        """Merge a pair of tokens in the token list with a new token.
+
+        If a `changes` list is given, the resulting pair count updates are
+        appended to it as (pair, +1/-1), so callers need not recount pairs.
+        """
+        first, second = pair
+        newids = array(typecode)
+        n = len(ids)
         i = 0
-        while i < len(ids):
-            if i < len(ids) - 1 and ids[i] == pair[0] and ids[i + 1] == pair[1]:
+        while i < n - 1:
+            try:
+                j = ids.index(first, i, n - 1)
+            except ValueError:
+                break
+            if ids[j + 1] == second:
+                newids.extend(ids[i:j])
+                if changes is not None:
+                    # The left neighbour is read from newids, so back-to-back
+                    # merges cancel out the pair the previous one just added
+                    if newids:
+                        changes.append(((newids[-1], first), -1))
+                        changes.append(((newids[-1], idx), 1))
+                    if j + 2 < n:
+                        changes.append(((second, ids[j + 2]), -1))
+                        changes.append(((idx, ids[j + 2]), 1))
                 newids.append(idx)
-                i += 2  # Skip the pair
+                i = j + 2  # Skip the pair
             else:
-                newids.append(ids[i])
-                i += 1
+                newids.extend(ids[i:j + 1])
+                i = j + 1
+        newids.extend(ids[i:])
         return newids
 
     def learn_bpe(self, text, num_merges):
-        """Perform the BPE algorithm to merge the most frequent pairs."""
-        ids = list(text.encode("utf-8"))
+        """Perform the BPE algorithm to merge the most frequent pairs.
+
+        Pairs never cross a piece boundary (see split_pieces), so training runs
+        on the distinct pieces weighted by their frequency, as in Sennrich et al.
+        Each pair keeps the set of words it occurs in, so a merge only rewrites
+        those words. The most frequent pair is taken from a max-heap with lazy
+        deletion.
+        """
+        pieces = split_pieces(text, self.max_piece_len)
+        word_freqs = Counter(pieces)
+        # Words stay as bytes until their first merge, then become packed arrays
+        typecode = self._typecode(255 + num_merges)
+        words = [word.encode("utf-8") for word in word_freqs]
+        freqs = list(word_freqs.values())
+
+        counts = Counter()
+        where = defaultdict(set)
+        for w, (word, freq) in enumerate(zip(words, freqs)):
+            for pair, count in self.get_stats(word).items():
+                counts[pair] += count * freq
+                where[pair].add(w)
+        # Ties go to the pair that was seen first
+        order = {pair: k for k, pair in enumerate(counts)}
+        heap = [(-count, order[pair], pair) for pair, count in counts.items()]
+        heapq.heapify(heap)
+        touched = set()
 
         for i in range(num_merges):
-            stats = self.get_stats(ids)
-            if not stats:
+            pair = None
+            while heap:
+                neg_count, _, candidate = heapq.heappop(heap)
+                if counts.get(candidate) == -neg_count:
+                    pair = candidate
+                    break
+            if pair is None:
                 # print(f"Warning: No pairs to merge after {i} merges.")
-                break 
+                break
 
-            pair = max(stats, key=stats.get)
             idx = 256 + i
             # print(f"merging {pair} into a new token {idx}")
-            ids = self.merge(ids, pair, idx)
+            del counts[pair]
+            for w in where.pop(pair):
+                changes = []
+                words[w] = self.merge(words[w], pair, idx, typecode, changes)
+                for changed, delta in changes:
+                    if changed == pair:
+                        continue
+                    counts[changed] += delta * freqs[w]
+                    if not counts[changed]:
+                        del counts[changed]
+                        where.pop(changed, None)
+                    if delta > 0:
+                        # Words that lose a pair stay in its set; merging them is a no-op
+                        where[changed].add(w)
+                        order.setdefault(changed, len(order))
+                    touched.add(changed)
+            # One heap entry per changed pair per merge, rather than one per update
+            for changed in touched:
+                if changed in counts:
+                    heapq.heappush(heap, (-counts[changed], order[changed], changed))
+            touched.clear()
+            # Lazy deletion leaves stale entries behind; rebuild once they dominate
+            if len(heap) > 2 * len(counts) + 64:
+                heap = [(-count, order[p], p) for p, count in counts.items()]
+                heapq.heapify(heap)
             self.merges[pair] = idx
+            self.vocab[idx] = self.vocab[pair[0]] + self.vocab[pair[1]]
 
-        return ids
+        self._encode_piece.cache_clear()
 
-    def encode(self, text):
-        """Encode the text using learned BPE merges."""
-        tokens = list(text.encode("utf-8"))
-        
-        while True:
-            stats = self.get_stats(tokens)
-            valid_pairs = [pair for pair in stats if pair in self.merges]
-
-            if not valid_pairs:
-                # print("Warning: No valid pairs to merge. Stopping encoding.")
-                break
+        word_ids = dict(zip(word_freqs, words))
+        encoded = array(typecode)
+        for piece in pieces:
+            encoded.extend(word_ids[piece])
+        return encoded
 
-            pair = min(valid_pairs, key=lambda p: self.merges.get(p, float("inf")))
-            idx = self.merges[pair]
-            tokens = self.merge(tokens, pair, idx)
+    def encode(self, text):
+        """Encode the text using learned BPE merges.
 
+        The text is split into whitespace and non-whitespace pieces of at most
+        max_piece_len characters, and each distinct piece is encoded once and
+        then served from a cache.
+        """
+        tokens = array(self._typecode(255 + len(self.merges)))
+        for piece in split_pieces(text, self.max_piece_len):
+            tokens.extend(self._encode_piece(piece))
         return tokens
 
+    def _encode_piece(self, piece):
+        """Encode a single piece, returning a tuple of token ids.
+
+        As in tiktoken's byte_pair_merge, the rank of every adjacent pair is
+        looked up once. The lowest-ranked pair is popped from a heap (stale
+        entries are skipped), merged, and only its two neighbours are re-ranked,
+        instead of recounting all pairs after every merge.
+        """
+        tokens = tuple(piece.encode("utf-8"))
+        # Nothing to merge: skip building the linked list and heap
+        if len(tokens) < 2 or not any(pair in self.merges for pair in pairwise(tokens)):
+            return tokens
+
+        tokens = list(tokens)
+        n = len(tokens)
+        prev = list(range(-1, n - 1))
+        nxt = list(range(1, n))
+        nxt.append(-1)
+
+        # A merge's id doubles as its rank: earlier merges have lower ids
+        heap = []
+        for i in range(n - 1):
+            rank = self.merges.get((tokens[i], tokens[i + 1]))
+            if rank is not None:
+                heap.append((rank, i))
+        heapq.heapify(heap)
+
+        while heap:
+            rank, i = heapq.heappop(heap)
+            j = nxt[i]
+            if j < 0 or self.merges.get((tokens[i], tokens[j])) != rank:
+                continue
+
+            tokens[i] = rank
+            after = nxt[j]
+            nxt[i], nxt[j] = after, -2
+            if after != -1:
+                prev[after] = i
+                right_rank = self.merges.get((rank, tokens[after]))
+                if right_rank is not None:
+                    heapq.heappush(heap, (right_rank, i))
+            left = prev[i]
+            if left != -1:
+                left_rank = self.merges.get((tokens[left], rank))
+                if left_rank is not None:
+                    heapq.heappush(heap, (left_rank, left))
+
+        encoded = []
+        i = 0
+        while i != -1:
+            encoded.append(tokens[i])
+            i = nxt[i]
+        return tuple(encoded)
+
     def decode(self, ids):
         """Decode a list of token IDs back into text."""
-        if not self.vocab:
-            self.initialize_vocab()
-
         tokens = b"".join(self.vocab[idx] for idx in ids)
         text = tokens.decode("utf-8", errors="replace")
         return text
 
-    def initialize_vocab(self):
-        """Initialize vocabulary from the BPE merges."""
-        self.vocab = {idx: bytes([idx]) for idx in range(256)}
-        
-        for (p0, p1), idx in self.merges.items():
-            self.vocab[idx] = self.vocab[p0] + self.vocab[p1]
-
     def process(self, text, num_merges):
         """Process the text: learn BPE, encode, and decode."""
-        self.learn_bpe(text, num_merges)
-        encoded_tokens = self.encode(text)
+        # learn_bpe already returns the text encoded with the learned merges
+        encoded_tokens = self.learn_bpe(text, num_merges)
         decoded_text = self.decode(encoded_tokens)
 
         vocab_size = len(self.vocab)
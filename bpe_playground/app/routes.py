@@ -1,22 +1,37 @@
-from flask import request, jsonify
+import msgpack
+import orjson
+from flask import request
 from app.bpe import BPEProcessor
 
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+def json_response(app, payload, status=200):
+    """Serialize the payload with orjson instead of Flask's stdlib-based jsonify."""
+    return app.response_class(orjson.dumps(payload), status=status, mimetype='application/json')
+
+def msgpack_response(app, payload, status=200):
+    """Serialize the payload with msgpack; small token ids pack into 1-3 bytes each."""
+    return app.response_class(msgpack.packb(payload, use_bin_type=True), status=status, mimetype=MSGPACK_MIMETYPE)
+
 def init_routes(app):
     @app.route('/bpe', methods=['POST'])
     def bpe():
         data = request.get_json()
-        print(data)
         text = data.get('text')
         num_merges = data.get('num_merges', 10)  
         if not text:
-            return jsonify({'error': 'No text provided'}), 400
+            return json_response(app, {'error': 'No text provided'}, 400)
 
         bpe_processor = BPEProcessor()
         encoded_tokens, decoded_text, vocab_size, num_merges_done = bpe_processor.process(text, num_merges)
         
-        return jsonify({
-            'encoded_tokens': encoded_tokens,
+        result = {
+            'encoded_tokens': encoded_tokens.tolist(),
             'decoded_text': decoded_text,
             'vocab_size': vocab_size,
             'num_merges': num_merges_done
-        })
+        }
+        # Clients that ask for msgpack get the compact binary encoding; JSON stays the default
+        if request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE:
+            return msgpack_response(app, result)
+        return json_response(app, result)
@@ -1,3 +1,4 @@
+import msgpack
 import streamlit as st
 import requests
 
@@ -57,9 +58,17 @@ except ValueError:
 
 if st.button("Process Text", key="process_button"):
     if text:
-        response = requests.post("http://127.0.0.1:5000/bpe", json={"text": text, "num_merges": num_merges})
+        response = requests.post(
+            "http://127.0.0.1:5000/bpe",
+            json={"text": text, "num_merges": num_merges},
+            headers={"Accept": "application/msgpack"},
+        )
         if response.status_code == 200:
-            result = response.json()
+            # The backend only answers in msgpack when content negotiation picks it
+            if response.headers.get("Content-Type", "").startswith("application/msgpack"):
+                result = msgpack.unpackb(response.content, raw=False)
+            else:
+                result = response.json()
             encoded_tokens = result['encoded_tokens']
             decoded_text = result['decoded_text']
             vocab_size = result['vocab_size']
@@ -1,7 +1,56 @@
 import argparse
 import ast
-import dill as pickle
-from collections import Counter
+import functools
+import heapq
+import pickle
+import re
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter, defaultdict
+from itertools import pairwise
+
+# Whitespace and non-whitespace runs; joining the pieces gives back the text
+SPLIT_PATTERN = re.compile(r"\S+|\s+")
+ENCODE_CACHE_SIZE = 100_000
+# Longer pieces are cut into chunks so one unbroken run cannot dominate encoding
+MAX_PIECE_LEN = 500
+
+
+def split_pieces(text: str, max_piece_len: int = MAX_PIECE_LEN):
+    """Split text with SPLIT_PATTERN, cutting pieces longer than max_piece_len characters."""
+    pieces = []
+    for piece in SPLIT_PATTERN.findall(text):
+        if len(piece) > max_piece_len:
+            pieces.extend(piece[i:i + max_piece_len] for i in range(0, len(piece), max_piece_len))
+        else:
+            pieces.append(piece)
+    return pieces
+
+
+def _count_pieces(text: str, max_piece_len: int = MAX_PIECE_LEN) -> Counter:
+    """Count the distinct pieces of a chunk of text (run in worker processes)."""
+    return Counter(split_pieces(text, max_piece_len))
+
+
+def _split_chunks(text: str, n_chunks: int):
+    """
+    Split text into about n_chunks slices without cutting through a piece.
+
+    Pieces are maximal runs of whitespace or non-whitespace, so a cut is only
+    made where one kind of run ends and the other begins.
+    """
+    size = max(len(text) // n_chunks, 1)
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text) and text[end - 1].isspace() == text[end].isspace():
+            # The cut fell inside a run; the regex finds where it ends in C
+            end = SPLIT_PATTERN.match(text, end).end()
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
 
 class Tokenizer:
     """
@@ -11,22 +60,31 @@ class Tokenizer:
         input_file (str): Path to the training text file.
         req_tokens (int): Desired final vocabulary size (capped at max_vocab_size).
         verbose (bool): Whether to display merge steps during training.
-        words (dict): Base mapping from byte-tuples and merge IDs to string tokens.
-        merges (dict): Mapping from byte-pair tuples to new merge IDs.
+        workers (int): Number of processes used to count the training text.
+        max_piece_len (int): Pieces longer than this many characters are split into chunks.
+        word_freqs (Counter): Frequency of each distinct piece of the training text.
+        words (dict): Mapping from byte values and merge IDs to the bytes they stand for.
+        merges (dict): Mapping from ID pairs to new merge IDs.
     """
-    def __init__(self, input_file: str, req_tokens: int = 300, max_vocab_size: int = 300, verbose: bool = False):
+    def __init__(self, input_file: str, req_tokens: int = 512, max_vocab_size: int = 1024, verbose: bool = False,
+                 workers: int = 1, max_piece_len: int = MAX_PIECE_LEN):
         """
         Initialize the Tokenizer and train on provided text.
 
         Args:
             input_file (str): Path to the input Nepali text data.
-            req_tokens (int): Desired vocabulary size (will be capped at max_vocab_size).
-            max_vocab_size (int): Maximum allowed vocabulary size (default: 300).
+            req_tokens (int): Desired vocabulary size, including the 256 byte tokens
+                (will be capped at max_vocab_size; default: 512).
+            max_vocab_size (int): Maximum allowed vocabulary size (default: 1024).
             verbose (bool): If True, display merge steps during training.
+            workers (int): Processes used to count pieces of the training text (default: 1).
+            max_piece_len (int): Maximum piece length in characters (default: 500).
         """
         self.input_file = input_file
         self.max_vocab_size = max_vocab_size
         self.verbose = verbose
+        self.workers = workers
+        self.max_piece_len = max_piece_len
         # Cap requested tokens to maximum
         if req_tokens > self.max_vocab_size:
             print(f"Requested vocab size {req_tokens} exceeds max {self.max_vocab_size}; using {self.max_vocab_size} instead.")
@@ -35,130 +93,277 @@ class Tokenizer:
             self.req_tokens = req_tokens
         self._initial_token_id = 256
         self._load_data()
+        self._init_cache()
+
+    def _init_cache(self):
+        """Wrap the piece encoder in a per-instance LRU cache."""
+        self._encode_piece = functools.lru_cache(maxsize=ENCODE_CACHE_SIZE)(self._encode_piece)
 
     def _load_data(self):
         """
-        Load text, initialize base characters, and compute BPE merges.
+        Load text, count its distinct pieces, and compute BPE merges.
         """
         with open(self.input_file, 'r', encoding='utf-8') as f:
             self.sentence = f.read()
 
-        english_chars = set('abcdefghijklmnopqrstuvwxyz0123456789')
-        nepali_chars = {ch for ch in self.sentence if ch.lower() not in english_chars}
-        self.words = {tuple(ch.encode('utf-8')): ch for ch in nepali_chars}
-        base_vocab = len(self.words)
-        self.req_merges = max(self.req_tokens - base_vocab, 0)
+        # The 256 byte values are the base vocabulary; every merge adds one token
+        self.req_merges = max(self.req_tokens - self._initial_token_id, 0)
         self.next_token_id = self._initial_token_id
-        self.tokens = [tuple(ch.encode('utf-8')) for ch in self.sentence]
+        # Merges never cross a piece boundary, so each distinct piece is trained once
+        chunks = _split_chunks(self.sentence, self.workers) if self.workers > 1 else []
+        if len(chunks) > 1:
+            self.word_freqs = Counter()
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                for counts in executor.map(_count_pieces, chunks, [self.max_piece_len] * len(chunks)):
+                    self.word_freqs.update(counts)
+        else:
+            # Starting worker processes is not worth it for a single chunk
+            self.word_freqs = _count_pieces(self.sentence, self.max_piece_len)
         self.merges = self._get_merges()
+        self.words = {idx: bytes([idx]) for idx in range(self._initial_token_id)}
+        for (a, b), idx in self.merges.items():
+            self.words[idx] = self.words[a] + self.words[b]
+        self._build_word_list()
+
+    def _build_word_list(self):
+        """Lay out the vocabulary as a list indexed directly by token ID for decode."""
+        self.word_list = [None] * (max(self.words) + 1)
+        for idx, token in self.words.items():
+            self.word_list[idx] = token
 
     def _find_common_pair(self, tokens):
         """Return frequency counts of adjacent token pairs."""
-        return Counter(zip(tokens, tokens[1:]))
-
-    def _merge(self, tokens, pair, new_id):
-        """Merge occurrences of 'pair' in tokens into new_id."""
-        merged = []
-        i = 0
-        while i < len(tokens):
-            if i < len(tokens) - 1 and tokens[i] == pair[0] and tokens[i+1] == pair[1]:
-                merged.append(new_id)
-                i += 2
-            else:
-                merged.append(tokens[i])
-                i += 1
-        return merged
+        return Counter(pairwise(tokens))
+
+    def _merge(self, tokens, pair, new_id, changes=None):
+        """
+        Merge occurrences of 'pair' in tokens into new_id, in place.
+
+        Merging only shrinks the buffer, so tokens are compacted towards the front
+        with a write index and the tail is truncated; the buffer is compacted in
+        place rather than rebuilt.
+        If 'changes' is a list, the pair count updates caused by each merge are
+        appended to it as (pair, +1/-1).
+        """
+        first, second = pair
+        n = len(tokens)
+        w = start = i = 0  # tokens[start:i] are kept but not yet moved to w
+        while i < n - 1:
+            # index() scans in C, skipping tokens that cannot start the pair
+            try:
+                j = tokens.index(first, i, n - 1)
+            except ValueError:
+                break
+            if tokens[j+1] != second:
+                i = j + 1
+                continue
+            if w != start:
+                tokens[w:w + j - start] = tokens[start:j]
+            w += j - start
+            if changes is not None:
+                # Left neighbour is the already-written token, so back-to-back
+                # merges cancel the pair the previous merge added
+                if w:
+                    changes.append(((tokens[w-1], first), -1))
+                    changes.append(((tokens[w-1], new_id), 1))
+                if j + 2 < n:
+                    changes.append(((second, tokens[j+2]), -1))
+                    changes.append(((new_id, tokens[j+2]), 1))
+            tokens[w] = new_id
+            w += 1
+            i = start = j + 2
+        if w != start:
+            tokens[w:w + n - start] = tokens[start:n]
+        w += n - start
+        del tokens[w:]
 
     def _get_merges(self):
-        """Perform BPE merges; display steps if verbose."""
+        """
+        Perform BPE merges; display steps if verbose.
+
+        Training runs on the distinct pieces of the text, each weighted by its
+        frequency (Sennrich et al.). Every pair keeps the set of words it occurs in,
+        so a merge only rewrites those words. The most frequent pair comes from a
+        lazily pruned max-heap.
+        """
         merges = {}
+        # Byte values are the base token IDs: one encode call per distinct piece
+        words = [list(word.encode('utf-8')) for word in self.word_freqs]
+        freqs = list(self.word_freqs.values())
+
+        pair_count = Counter()
+        pair_words = defaultdict(set)
+        for w, (word, freq) in enumerate(zip(words, freqs)):
+            for pair, count in self._find_common_pair(word).items():
+                pair_count[pair] += count * freq
+                pair_words[pair].add(w)
+        # Tie-break on first appearance
+        order = {pair: k for k, pair in enumerate(pair_count)}
+        heap = [(-count, order[pair], pair) for pair, count in pair_count.items()]
+        heapq.heapify(heap)
+        touched = set()
+
         for _ in range(self.req_merges):
-            pair_counts = self._find_common_pair(self.tokens)
-            if not pair_counts:
+            pair = None
+            while heap:
+                neg_count, _, candidate = heapq.heappop(heap)
+                if pair_count.get(candidate) == -neg_count:
+                    pair = candidate
+                    break
+            if pair is None:
                 break
-            # Identify most frequent pair
-            pair, _ = pair_counts.most_common(1)[0]
             new_id = self.next_token_id
             if self.verbose:
                 print(f"merging {pair} into a new token {new_id}")
-            self.tokens = self._merge(self.tokens, pair, new_id)
+            del pair_count[pair]
+            for w in pair_words.pop(pair):
+                changes = []
+                self._merge(words[w], pair, new_id, changes)
+                for changed, delta in changes:
+                    if changed == pair:
+                        continue
+                    pair_count[changed] += delta * freqs[w]
+                    if not pair_count[changed]:
+                        del pair_count[changed]
+                        pair_words.pop(changed, None)
+                    if delta > 0:
+                        # A word that loses a pair stays in its set; merging it later is a no-op
+                        pair_words[changed].add(w)
+                        order.setdefault(changed, len(order))
+                    touched.add(changed)
+            # One heap entry per changed pair per merge, rather than one per update
+            for changed in touched:
+                if changed in pair_count:
+                    heapq.heappush(heap, (-pair_count[changed], order[changed], changed))
+            touched.clear()
+            # Lazy deletion leaves stale entries behind; rebuild once they dominate
+            if len(heap) > 2 * len(pair_count) + 64:
+                heap = [(-count, order[p], p) for p, count in pair_count.items()]
+                heapq.heapify(heap)
             merges[pair] = new_id
             self.next_token_id += 1
         return merges
 
     def encode(self, text: str):
         """Encode text to a sequence of token IDs using learned merges."""
-        tokens = [tuple(ch.encode('utf-8')) for ch in text]
+        ids = []
+        for piece in split_pieces(text, self.max_piece_len):
+            ids.extend(self._encode_piece(piece))
+        return ids
+
+    def _encode_piece(self, piece: str):
+        """Encode one whitespace-delimited piece; results are cached per instance."""
+        # Byte values are the base IDs; array('I', some_bytes) would read raw machine words
+        tokens = array('I', list(piece.encode('utf-8')))
+        # Skip the Counter entirely when no adjacent pair has a merge
+        if len(tokens) < 2 or not any(p in self.merges for p in pairwise(tokens)):
+            return tuple(tokens)
+        inf = float('inf')
         while True:
-            pair_counts = self._find_common_pair(tokens)
-            candidates = [(p, mid) for p, mid in self.merges.items() if p in pair_counts]
-            if not candidates:
+            # Look up the pairs present in the piece rather than scanning every merge
+            best, best_id = None, inf
+            for p in pairwise(tokens):
+                mid = self.merges.get(p, inf)
+                if mid < best_id:
+                    best, best_id = p, mid
+            if best is None:
                 break
-            pair, _ = min(candidates, key=lambda x: x[1])
-            tokens = self._merge(tokens, pair, self.merges[pair])
-        return tokens
+            self._merge(tokens, best, best_id)
+        return tuple(tokens)
 
     def decode(self, ids):
         """Decode a list of token IDs back into the original string."""
-        for (a, b), idx in self.merges.items():
-            if idx not in self.words:
-                str_a = self.words.get(a, chr(a) if isinstance(a, int) and a < 256 else '')
-                str_b = self.words.get(b, chr(b) if isinstance(b, int) and b < 256 else '')
-                self.words[idx] = str_a + str_b
-        # Build output string
-        result = []
+        word_list = self.word_list
+        parts = []
         for token in ids:
-            if token in self.words:
-                result.append(self.words[token])
-            elif isinstance(token, int) and token < 256:
-                result.append(chr(token))
-            else:
+            # Negative indices would silently wrap around to the end of the list
+            if not isinstance(token, int) or not 0 <= token < len(word_list):
                 raise KeyError(f"No mapping found for token {token}")
-        return ''.join(result)
+            parts.append(word_list[token])
+        return b''.join(parts).decode('utf-8', errors='replace')
 
     def save(self, filepath: str):
-        """Save the tokenizer instance to a dill pickle."""
+        """Save the learned merges and vocabulary (not the training text) to a pickle."""
         with open(filepath, 'wb') as f:
-            pickle.dump(self, f)
+            pickle.dump({'merges': self.merges, 'words': self.words, 'max_piece_len': self.max_piece_len,
+                         'initial_token_id': self._initial_token_id}, f, protocol=5)
+
+    @classmethod
+    def load(cls, filepath: str):
+        """
+        Load a tokenizer written by save(), without retraining.
+
+        Attributes that only describe the training run (input_file, sentence,
+        word_freqs) are set to None.
+        """
+        with open(filepath, 'rb') as f:
+            data = pickle.load(f)
+        tokenizer = cls.__new__(cls)
+        tokenizer.input_file = None
+        tokenizer.sentence = None
+        tokenizer.word_freqs = None
+        tokenizer.verbose = False
+        tokenizer.workers = 1
+        tokenizer.max_piece_len = data.get('max_piece_len', MAX_PIECE_LEN)
+        tokenizer._initial_token_id = data.get('initial_token_id', 256)
+        tokenizer.merges = data['merges']
+        tokenizer.words = data['words']
+        tokenizer.req_tokens = tokenizer.max_vocab_size = len(tokenizer.words)
+        tokenizer.req_merges = len(tokenizer.merges)
+        tokenizer.next_token_id = tokenizer._initial_token_id + len(tokenizer.merges)
+        tokenizer._build_word_list()
+        tokenizer._init_cache()
+        return tokenizer
 
     def show_vocab(self):
         """Return a sorted list of (token, representation) for vocabulary."""
-        items = []
-        for key, val in self.words.items():
-            items.append((key, val))
-        items.sort(key=lambda x: (isinstance(x[0], tuple), x[0]))
-        return items
+        return [(idx, tok.decode('utf-8', errors='replace')) for idx, tok in sorted(self.words.items())]
 
 
 def main():
-    """CLI: train tokenizer, then encode, decode, save, or show vocab."""
+    """CLI: train or load tokenizer, then encode, decode, save, or show vocab."""
     parser = argparse.ArgumentParser(description="Nepali BPE Tokenizer CLI")
-    parser.add_argument('-i', '--input-file', required=True,
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-i', '--input-file',
                         help="Path to input Nepali text file")
-    parser.add_argument('-r', '--req-tokens', type=int, default=300,
-                        help="Desired vocabulary size (max 300; default: 300)")
+    source.add_argument('-l', '--load-file',
+                        help="Path to a tokenizer pickle written by --save-file")
+    # Training options default to None so they can be rejected with --load-file
+    parser.add_argument('-r', '--req-tokens', type=int,
+                        help="Desired vocabulary size, including the 256 byte tokens (max 1024; default: 512)")
     parser.add_argument('-v', '--verbose', action='store_true',
                         help="Display merge steps during training")
+    parser.add_argument('-j', '--workers', type=int,
+                        help="Processes used to count the training text (default: 1)")
     parser.add_argument('--encode', help="Text to encode into token IDs")
-    parser.add_argument('--decode', help="Python-style list or tuple of token IDs (e.g. '(256,258),32')")
+    parser.add_argument('--decode', help="Python-style list of token IDs (e.g. '256,258,32')")
     parser.add_argument('--show-vocab', action='store_true',
                         help="Display the learned vocabulary mapping")
     parser.add_argument('-s', '--save-file', help="Path to save trained tokenizer pickle")
     args = parser.parse_args()
 
-    max_vocab = 300
-    if args.req_tokens > max_vocab:
-        print(f"Requested vocab size {args.req_tokens} exceeds max {max_vocab}; using {max_vocab} instead.")
-        args.req_tokens = max_vocab
-
-    tokenizer = Tokenizer(
-        input_file=args.input_file,
-        req_tokens=args.req_tokens,
-        max_vocab_size=max_vocab,
-        verbose=args.verbose
-    )
-
-    print(f"Training complete: {len(tokenizer.merges)} merges applied, final vocabulary size is {len(tokenizer.words)} tokens.")
+    if args.load_file:
+        training_flags = [flag for flag, value in (('--req-tokens', args.req_tokens is not None),
+                                                   ('--verbose', args.verbose),
+                                                   ('--workers', args.workers is not None)) if value]
+        if training_flags:
+            parser.error(f"{', '.join(training_flags)} only apply when training with --input-file")
+        tokenizer = Tokenizer.load(args.load_file)
+        print(f"Tokenizer loaded from {args.load_file}: vocabulary size is {len(tokenizer.words)} tokens.")
+    else:
+        max_vocab = 1024
+        req_tokens = 512 if args.req_tokens is None else args.req_tokens
+        if req_tokens > max_vocab:
+            print(f"Requested vocab size {req_tokens} exceeds max {max_vocab}; using {max_vocab} instead.")
+            req_tokens = max_vocab
+        tokenizer = Tokenizer(
+            input_file=args.input_file,
+            req_tokens=req_tokens,
+            max_vocab_size=max_vocab,
+            verbose=args.verbose,
+            workers=1 if args.workers is None else args.workers
+        )
+        print(f"Training complete: {len(tokenizer.merges)} merges applied, final vocabulary size is {len(tokenizer.words)} tokens.")
 
     # Encode text
     if args.encode: